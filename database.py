@@ -5,12 +5,11 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import BulkWriteError
 from datetime import datetime, timezone
 import os
 from dotenv import load_dotenv
-from typing import Union
-from pydantic import BaseModel
 
 # Load environment variables from .env file
 load_dotenv()
@@ -21,35 +20,103 @@ db = None
 database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
+# Pool limits are per process. A single process gets 200/20; when WEB_CONCURRENCY
+# says there are several workers (main.py and start_server.sh set it), one
+# MONGO_MAX_CONNECTIONS budget is split between them instead.
+_max_pool_size, _min_pool_size = 200, 20
+if os.getenv("WEB_CONCURRENCY"):
+    _workers = max(1, int(os.getenv("WEB_CONCURRENCY")))
+    if _workers > 1:
+        # Each worker needs at least one connection, so the budget is only exceeded
+        # when there are more workers than MONGO_MAX_CONNECTIONS
+        _max_pool_size = max(1, int(os.getenv("MONGO_MAX_CONNECTIONS", 100)) // _workers)
+        _min_pool_size = 1
+
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    # One pooled client per process; keep warm connections and compress the wire protocol
+    _client = AsyncIOMotorClient(
+        database_url,
+        maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", _max_pool_size)),
+        minPoolSize=int(os.getenv("MONGO_MIN_POOL_SIZE", _min_pool_size)),
+        serverSelectionTimeoutMS=2000,
+        compressors="zstd,zlib",
+    )
     db = _client[database_name]
 
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
+async def create_document(collection_name: str, data: dict):
     """Insert a single document with timestamp"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
 
-    # Convert Pydantic model to dict if needed
-    if isinstance(data, BaseModel):
-        data_dict = data.model_dump()
-    else:
-        data_dict = data.copy()
+    data_dict = data.copy()
 
     data_dict['created_at'] = datetime.now(timezone.utc)
     data_dict['updated_at'] = datetime.now(timezone.utc)
 
-    result = db[collection_name].insert_one(data_dict)
+    result = await db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
-    """Get documents from collection"""
+async def create_documents(collection_name: str, data_list: list):
+    """Insert many documents with timestamps in one round-trip"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+    if not data_list:
+        return {'ids': [], 'errors': []}
+
+    now = datetime.now(timezone.utc)
+    docs = [{**data, 'created_at': now, 'updated_at': now} for data in data_list]
+
+    # Unordered lets the server apply the batch in parallel and continue past failures
+    try:
+        result = await db[collection_name].insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        # The rest of the batch was still written; report which documents failed
+        write_errors = e.details.get('writeErrors', [])
+        failed = {err['index'] for err in write_errors}
+        return {
+            'ids': [str(doc['_id']) for i, doc in enumerate(docs) if i not in failed],
+            'errors': [{'index': err['index'], 'message': err.get('errmsg')} for err in write_errors],
+        }
+    return {'ids': [str(i) for i in result.inserted_ids], 'errors': []}
+
+def find_documents(collection_name: str, filter_dict: dict = None, limit: int = None, sort: list = None, projection: dict = None):
+    """Get a cursor over documents from collection, for iterating with `async for`"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
     
-    cursor = db[collection_name].find(filter_dict or {})
+    cursor = db[collection_name].find(filter_dict or {}, projection)
+    if sort:
+        cursor = cursor.sort(sort)
     if limit:
         cursor = cursor.limit(limit)
     
-    return list(cursor)
+    return cursor
+
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None, sort: list = None, projection: dict = None):
+    """Get documents from collection"""
+    cursor = find_documents(collection_name, filter_dict, limit, sort, projection)
+    return await cursor.to_list(length=limit)
+
+async def aggregate_documents(collection_name: str, pipeline: list):
+    """Run an aggregation pipeline and return all resulting documents"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    cursor = db[collection_name].aggregate(pipeline)
+    return await cursor.to_list(length=None)
+
+async def get_document(collection_name: str, filter_dict: dict = None, sort: list = None, projection: dict = None):
+    """Get the first document matching the filter in the given sort order"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    return await db[collection_name].find_one(filter_dict or {}, projection, sort=sort)
+
+async def count_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
+    """Count documents matching the filter, stopping early at limit if given"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    kwargs = {'limit': limit} if limit else {}
+    return await db[collection_name].count_documents(filter_dict or {}, **kwargs)
@@ -1,14 +1,54 @@
+import asyncio
+import itertools
+import logging
 import os
+import time
+import weakref
+from collections import defaultdict
 from datetime import datetime, timedelta, date
-from typing import List, Optional, Any, Dict
+from functools import lru_cache
+from typing import Annotated, AsyncIterator, List, Optional, Any, Dict
 
-from fastapi import FastAPI, HTTPException, Query
+import orjson
+from bson import ObjectId
+from cachetools import TTLCache
+from fastapi import Body, FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, PlainSerializer, SerializationInfo
+
+from database import (
+    db,
+    create_document,
+    create_documents,
+    get_document,
+    get_documents,
+    find_documents,
+    aggregate_documents,
+    count_documents,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _orjson_default(obj: Any) -> Any:
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError
+
+
+def _dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS)
 
-from database import db, create_document, get_documents
 
-app = FastAPI(title="Fitness Tracker API")
+class MongoJSONResponse(ORJSONResponse):
+    """orjson response that also understands BSON ObjectIds"""
+
+    def render(self, content: Any) -> bytes:
+        return _dumps(content)
+
+
+app = FastAPI(title="Fitness Tracker API", default_response_class=MongoJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,7 +60,23 @@ app.add_middleware(
 
 
 # --------- Models ---------
+_INPUT_CONFIG = ConfigDict(frozen=True, extra="forbid", str_strip_whitespace=True)
+
+
+def _date_to_bson(v: date, info: SerializationInfo) -> Any:
+    # BSON has no bare date type; python dumps (the ones stored in Mongo) get midnight datetimes
+    if info.mode == "python":
+        return datetime(v.year, v.month, v.day)
+    return v.isoformat()
+
+
+# Validated as a strict calendar date, dumped ready for storage
+CalendarDate = Annotated[date, PlainSerializer(_date_to_bson)]
+
+
 class ProfileIn(BaseModel):
+    model_config = _INPUT_CONFIG
+
     name: str
     email: str
     height_cm: Optional[float] = Field(None, gt=0)
@@ -28,8 +84,10 @@ class ProfileIn(BaseModel):
 
 
 class WorkoutIn(BaseModel):
+    model_config = _INPUT_CONFIG
+
     user_email: str
-    date: date
+    date: CalendarDate
     type: str
     duration_min: float = Field(..., gt=0)
     intensity: Optional[str] = None
@@ -39,8 +97,10 @@ class WorkoutIn(BaseModel):
 
 
 class BodyCompIn(BaseModel):
+    model_config = _INPUT_CONFIG
+
     user_email: str
-    date: date
+    date: CalendarDate
     weight_kg: Optional[float] = Field(None, gt=0)
     body_fat_pct: Optional[float] = Field(None, ge=0, le=100)
     waist_cm: Optional[float] = Field(None, gt=0)
@@ -49,28 +109,121 @@ class BodyCompIn(BaseModel):
 
 
 # --------- Utils ---------
+NEWEST_FIRST = [("date", -1), ("created_at", -1)]
+OLDEST_FIRST = [("date", 1), ("created_at", 1)]
+
+
+def _day_start(d: date) -> datetime:
+    return datetime(d.year, d.month, d.day)
+
+
+def _day_end(d: date) -> datetime:
+    return datetime(d.year, d.month, d.day, 23, 59, 59)
+
+
+def _as_date(v: Any) -> Any:
+    return v.date() if isinstance(v, datetime) else v
+
+
+@lru_cache(maxsize=256)
+def _norm_type(t: Optional[str]) -> str:
+    # Workout types are low-cardinality; reuse the title-cased string
+    return (t or "Unknown").title()
+
 
 def _serialize(doc: Dict[str, Any]) -> Dict[str, Any]:
+    # Mutates in place; orjson renders datetimes natively
     if not doc:
         return doc
-    d = dict(doc)
-    if "_id" in d:
-        d["id"] = str(d.pop("_id"))
-    # Convert datetime/date to isoformat
-    for k, v in list(d.items()):
-        if isinstance(v, (datetime, date)):
-            d[k] = v.isoformat()
-    return d
+    if "_id" in doc:
+        doc["id"] = str(doc.pop("_id"))
+    # Stored as midnight datetime; expose the calendar date only
+    if "date" in doc:
+        doc["date"] = _as_date(doc["date"])
+    return doc
+
+
+async def _stream_json_array(first: Dict[str, Any], cursor) -> AsyncIterator[bytes]:
+    # Write each document as the cursor yields it instead of building the full list
+    yield b"[" + _dumps(_serialize(first))
+    async for doc in cursor:
+        yield b"," + _dumps(_serialize(doc))
+    yield b"]"
+
+
+async def _stream_documents(cursor) -> Response:
+    # Read the first document before committing to a 200 so query and
+    # connection errors still surface as a proper error status
+    first = await anext(cursor, None)
+    if first is None:
+        return MongoJSONResponse([])
+    return StreamingResponse(_stream_json_array(first, cursor), media_type="application/json")
+
+
+# Short-lived insights results keyed by (user_email, days, today, generation). A write
+# gives the user a new generation, so older entries are simply never read again and
+# age out through the TTL.
+# The cache, its counters and the write generations are per process: with several
+# uvicorn workers a write only invalidates the worker that handled it, so other
+# workers may serve a result up to INSIGHTS_CACHE_TTL seconds old. Set it to 0 to
+# disable caching when that staleness is not acceptable.
+_INSIGHTS_TTL = float(os.getenv("INSIGHTS_CACHE_TTL", 60))
+_insights_cache: TTLCache = TTLCache(maxsize=10_000, ttl=max(_INSIGHTS_TTL, 1))
+_insights_locks: "weakref.WeakValueDictionary[tuple, asyncio.Lock]" = weakref.WeakValueDictionary()
+_insights_stats = {"hits": 0, "misses": 0}
+# Generations come from one process-wide sequence so a value is never reused, and
+# live at least as long as cache entries; once one expires, every entry keyed by it
+# has expired too. maxsize is kept well above the cache so eviction stays rare.
+_insights_write_seq = itertools.count(1)
+_insights_generation: TTLCache = TTLCache(maxsize=100_000, ttl=max(_INSIGHTS_TTL, 1))
+
+
+def _invalidate_insights(user_email: str) -> None:
+    _insights_generation[user_email] = next(_insights_write_seq)
+
+
+# --------- Startup ---------
+@app.on_event("startup")
+async def ensure_indexes():
+    if db is None:
+        return
+    # A database outage must not keep the API from starting; /test reports it
+    try:
+        # Equality (user_email), then sort/range (date), then sort tiebreak (created_at)
+        for name in ("workout", "bodycomposition"):
+            await db[name].create_index(
+                [("user_email", 1), ("date", -1), ("created_at", -1)]
+            )
+        # Covers the insights pipeline so it can be answered from the index alone
+        await db.workout.create_index(
+            [("user_email", 1), ("date", -1), ("type", 1), ("duration_min", 1)]
+        )
+    except Exception:
+        logger.exception("Could not create MongoDB indexes on startup")
 
 
 # --------- Basic ---------
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Fitness Tracker API running"}
 
 
+# /test is polled by health checks; only list collections every 30s
+_COLLECTIONS_TTL = 30.0
+_collections_cache: Dict[str, Any] = {"collections": [], "ts": None}
+
+
+async def _list_collections() -> List[str]:
+    now = time.monotonic()
+    ts = _collections_cache["ts"]
+    if ts is None or now - ts >= _COLLECTIONS_TTL:
+        _collections_cache["collections"] = (await db.list_collection_names())[:10]
+        _collections_cache["ts"] = now
+    return _collections_cache["collections"]
+
+
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -78,13 +231,15 @@ def test_database():
         "database_name": "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set",
         "connection_status": "Not Connected",
         "collections": [],
+        # Counters cover only the worker that answered this request
+        "insights_cache": {**_insights_stats, "size": len(_insights_cache), "worker_pid": os.getpid()},
     }
     try:
         if db is not None:
             response["database"] = "✅ Available"
             response["connection_status"] = "Connected"
             try:
-                response["collections"] = db.list_collection_names()[:10]
+                response["collections"] = await _list_collections()
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
                 response["database"] = f"⚠️ Connected but Error: {str(e)[:80]}"
@@ -97,95 +252,163 @@ def test_database():
 
 # --------- Profiles ---------
 @app.post("/api/profile")
-def create_profile(profile: ProfileIn):
-    pid = create_document("userprofile", profile)
+async def create_profile(profile: ProfileIn):
+    pid = await create_document("userprofile", profile.model_dump(mode="python"))
     return {"id": pid}
 
 
 @app.get("/api/profile")
-def get_profile(email: str = Query(..., description="User email")):
-    docs = get_documents("userprofile", {"email": email}, limit=1)
+async def get_profile(email: str = Query(..., description="User email")):
+    # Stored emails were whitespace-stripped by the input models; match that here
+    email = email.strip()
+    docs = await get_documents("userprofile", {"email": email}, limit=1)
     if not docs:
         raise HTTPException(status_code=404, detail="Profile not found")
-    return _serialize(docs[0])
+    return MongoJSONResponse(_serialize(docs[0]))
 
 
 # --------- Workouts ---------
 @app.post("/api/workouts")
-def add_workout(workout: WorkoutIn):
-    wid = create_document("workout", workout)
+async def add_workout(workout: WorkoutIn):
+    wid = await create_document("workout", workout.model_dump(mode="python"))
+    _invalidate_insights(workout.user_email)
     return {"id": wid}
 
 
+MAX_BULK_WORKOUTS = 500
+
+
+@app.post("/api/workouts/bulk")
+async def add_workouts_bulk(
+    workouts: List[WorkoutIn] = Body(..., max_length=MAX_BULK_WORKOUTS),
+):
+    try:
+        result = await create_documents(
+            "workout", [w.model_dump(mode="python") for w in workouts]
+        )
+        # Partial failures must not look like success to syncing clients
+        return MongoJSONResponse(result, status_code=207 if result["errors"] else 200)
+    finally:
+        # Part of the batch may be stored even if the insert raised
+        for email in {w.user_email for w in workouts}:
+            _invalidate_insights(email)
+
+
 @app.get("/api/workouts")
-def list_workouts(
+async def list_workouts(
     user_email: str,
     start: Optional[date] = Query(None, description="Start date inclusive YYYY-MM-DD"),
     end: Optional[date] = Query(None, description="End date inclusive YYYY-MM-DD"),
     limit: Optional[int] = Query(50, ge=1, le=500),
 ):
-    q: Dict[str, Any] = {"user_email": user_email}
+    q: Dict[str, Any] = {"user_email": user_email.strip()}
     if start or end:
         rng: Dict[str, Any] = {}
+        # Compare native datetimes against the indexed field as-is
         if start:
-            rng["$gte"] = start
+            rng["$gte"] = _day_start(start)
         if end:
-            # inclusive end; store dates as date so <= end works
-            rng["$lte"] = end
+            rng["$lte"] = _day_end(end)
         q["date"] = rng
-    docs = get_documents("workout", q, limit)
     # sort by date desc then created_at desc
-    docs.sort(key=lambda d: (d.get("date"), d.get("created_at")), reverse=True)
-    return [_serialize(d) for d in docs]
+    cursor = find_documents("workout", q, limit, sort=NEWEST_FIRST)
+    return await _stream_documents(cursor)
 
 
 # --------- Body Composition ---------
 @app.post("/api/bodycomp")
-def add_bodycomp(measure: BodyCompIn):
-    mid = create_document("bodycomposition", measure)
+async def add_bodycomp(measure: BodyCompIn):
+    mid = await create_document("bodycomposition", measure.model_dump(mode="python"))
+    _invalidate_insights(measure.user_email)
     return {"id": mid}
 
 
 @app.get("/api/bodycomp")
-def list_bodycomp(user_email: str, limit: int = Query(30, ge=1, le=365)):
-    docs = get_documents("bodycomposition", {"user_email": user_email}, limit)
-    docs.sort(key=lambda d: (d.get("date"), d.get("created_at")), reverse=True)
-    return [_serialize(d) for d in docs]
+async def list_bodycomp(user_email: str, limit: int = Query(30, ge=1, le=365)):
+    cursor = find_documents(
+        "bodycomposition", {"user_email": user_email.strip()}, limit, sort=NEWEST_FIRST
+    )
+    return await _stream_documents(cursor)
 
 
 # --------- Insights ---------
 @app.get("/api/insights")
-def insights(user_email: str, days: int = Query(30, ge=1, le=365)):
-    today = date.today()
+async def insights(user_email: str, days: int = Query(30, ge=1, le=365)):
+    user_email = user_email.strip()
+    if _INSIGHTS_TTL <= 0:
+        return await _compute_insights(user_email, days, date.today())
+    generation = _insights_generation.get(user_email, 0)
+    key = (user_email, days, date.today(), generation)
+    cached = _insights_cache.get(key)
+    if cached is not None:
+        _insights_stats["hits"] += 1
+        return cached
+    lock = _insights_locks.get(key)
+    if lock is None:
+        lock = _insights_locks[key] = asyncio.Lock()
+    async with lock:
+        # Another request may have filled the entry while we waited
+        cached = _insights_cache.get(key)
+        if cached is not None:
+            _insights_stats["hits"] += 1
+            return cached
+        _insights_stats["misses"] += 1
+        result = await _compute_insights(user_email, days, key[2])
+        # Don't store a result that a concurrent write already superseded
+        if _insights_generation.get(user_email, 0) == generation:
+            _insights_cache[key] = result
+        return result
+
+
+async def _compute_insights(user_email: str, days: int, today: date) -> Dict[str, Any]:
     start = today - timedelta(days=days - 1)
-    wdocs = get_documents(
+    # Let MongoDB sum sessions/minutes per (day, type); $match stays first for the index
+    rows = await aggregate_documents(
         "workout",
-        {"user_email": user_email, "date": {"$gte": start, "$lte": today}},
-        None,
+        [
+            {
+                "$match": {
+                    "user_email": user_email,
+                    "date": {"$gte": _day_start(start), "$lte": _day_end(today)},
+                }
+            },
+            # Project only after $match so the index bounds still apply
+            {"$project": {"date": 1, "duration_min": 1, "type": 1, "_id": 0}},
+            {
+                "$group": {
+                    "_id": {"day": "$date", "type": "$type"},
+                    "minutes": {"$sum": "$duration_min"},
+                    "sessions": {"$sum": 1},
+                }
+            },
+        ],
     )
-    # Aggregate
-    total_sessions = len(wdocs)
-    total_minutes = sum(float(w.get("duration_min", 0) or 0) for w in wdocs)
+    # Aggregate every accumulator in a single pass over the grouped rows
+    total_sessions = 0
+    total_minutes = 0.0
+    by_day: Dict[str, float] = defaultdict(float)
+    types: Dict[str, int] = defaultdict(int)
+    days_with = set()
+    for r in rows:
+        day = _as_date(r["_id"]["day"])
+        minutes = float(r["minutes"])
+        sessions = r["sessions"]
+        total_sessions += sessions
+        total_minutes += minutes
+        days_with.add(day)
+        by_day[day.isoformat()] += minutes
+        types[_norm_type(r["_id"].get("type"))] += sessions
     avg_duration = (total_minutes / total_sessions) if total_sessions else 0
-    by_day: Dict[str, float] = {}
-    types: Dict[str, int] = {}
+
+    # compute current streak ending today: walk the days newest first until a gap
     streak = 0
-    current_streak = 0
-
-    # Build a set of days with workouts
-    days_with = {str(w.get("date")) for w in wdocs}
-    # compute current streak ending today
-    d = today
-    while str(d) in days_with:
-        current_streak += 1
-        d = d - timedelta(days=1)
-    streak = current_streak
-
-    for w in wdocs:
-        ds = str(w.get("date"))
-        by_day[ds] = by_day.get(ds, 0) + float(w.get("duration_min", 0) or 0)
-        t = (w.get("type") or "Unknown").title()
-        types[t] = types.get(t, 0) + 1
+    expected = today
+    one_day = timedelta(days=1)
+    for d in sorted(days_with, reverse=True):
+        if d != expected:
+            break
+        streak += 1
+        expected -= one_day
 
     # Simple suggestions
     suggestions = []
@@ -197,16 +420,22 @@ def insights(user_email: str, days: int = Query(30, ge=1, le=365)):
         suggestions.append("Balance your routine by mixing different workout types.")
 
     # Body comp trend (last and first)
-    bdocs = get_documents(
-        "bodycomposition", {"user_email": user_email}, None
+    weighed = {"user_email": user_email, "weight_kg": {"$ne": None}}
+    only_weight = {"weight_kg": 1}
+    first = await get_document(
+        "bodycomposition", weighed, sort=OLDEST_FIRST, projection=only_weight
+    )
+    last = await get_document(
+        "bodycomposition", weighed, sort=NEWEST_FIRST, projection=only_weight
     )
-    bdocs.sort(key=lambda d: (d.get("date"), d.get("created_at")))
     weight_change = None
-    if len(bdocs) >= 2:
-        first = next((b for b in bdocs if b.get("weight_kg") is not None), None)
-        last = next((b for b in reversed(bdocs) if b.get("weight_kg") is not None), None)
-        if first and last:
-            weight_change = float(last.get("weight_kg")) - float(first.get("weight_kg"))
+    if first and last:
+        # As before, a trend needs at least two entries (weighed or not); a single
+        # weigh-in among them yields 0.0
+        if first["_id"] != last["_id"] or await count_documents(
+            "bodycomposition", {"user_email": user_email}, limit=2
+        ) >= 2:
+            weight_change = float(last["weight_kg"]) - float(first["weight_kg"])
 
     return {
         "totals": {
@@ -226,4 +455,15 @@ if __name__ == "__main__":
     import uvicorn
 
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+    # Worker processes re-import database.py, which sizes its pool from this
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+        log_level="warning",
+    )
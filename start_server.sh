@@ -15,5 +15,7 @@ mkdir -p logs
 echo "Installing dependencies..."
 pip install -r requirements.txt
 echo "Starting FastAPI server..."
-nohup uvicorn main:app --host 0.0.0.0 --port 8000 --reload > logs/server.log 2>&1 
+# Same worker default as main.py; exported so database.py can size its pool per worker
+export WEB_CONCURRENCY=${WEB_CONCURRENCY:-$(( $(nproc) * 2 + 1 ))}
+nohup uvicorn main:app --host 0.0.0.0 --port 8000 --workers "$WEB_CONCURRENCY" --loop uvloop --http httptools > logs/server.log 2>&1 
 echo "Server started in background"